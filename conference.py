@@ -6,22 +6,29 @@ conference.py -- Udacity conference server-side Python App Engine API;
 
 """
 from functools import wraps
+from time import time as current_time
 
+from datetime import date
 from datetime import datetime
+from datetime import time
 
 import endpoints
 import json
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protobuf
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException, SpeakerForm, Speaker, SessionForm, \
     SpeakerForms, Session, SessionForms
 from models import Profile
+from models import AlmostSoldOut
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
@@ -43,8 +50,21 @@ EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 MEMCACHE_FEATURED_SPEAKER = "FEATURED_SPEAKER"
+MEMCACHE_BEST_SPEAKERS_KEY = "BEST_SPEAKERS"
+MEMCACHE_UPCOMING_SESSIONS_KEY = "UPCOMING_SESSIONS"
+MEMCACHE_SESSION_TYPES_KEY = "SESSION_TYPES"
+MEMCACHE_CONF_SESSIONS_TPL = "CONFERENCE_SESSIONS_%s"
+CONFIRMATION_EMAIL_QUEUE = "confirmation-email"
+# per-instance copy of the featured speaker memcache entry
+FEATURED_SPEAKER_TTL = 30
+featured_speaker_cache = {'value': None, 'expires': 0}
+MEMCACHE_QUERY_TTL = 60
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ALMOST_SOLD_OUT_SEATS = 5
+ALMOST_SOLD_OUT_KEY = ndb.Key(AlmostSoldOut, 'almostSoldOut')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -85,6 +105,13 @@ SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     websafeSpeakerKey=messages.StringField(1),
 )
 
+SPEAKER_SESSIONS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSpeakerKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
 SPEAKER_POST_REQUEST = endpoints.ResourceContainer(
     SpeakerForm,
     websafeSpeakerKey=messages.StringField(1),
@@ -103,34 +130,165 @@ SESSION_POST_REQUEST = endpoints.ResourceContainer(
 SESSION_GET_BY_CONF_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
 )
 
 SESSION_GET_BY_CONF_TYPE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
 )
 
 SESSION_GET_BY_TYPE_TIME_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     typeOfSession=messages.StringField(1),
     startTime=messages.StringField(2),
+    websafeConferenceKey=messages.StringField(3),
+    pageSize=messages.IntegerField(4, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(5),
 )
 
 
 # - - - Utils - - - - - - - - - - - - - - - - - - - - - - - -
 
 def login_required(f):
+    """Require a signed in user; it is resolved once per API call and
+    kept on self._current_user / self._current_user_id meanwhile.
+    """
     @wraps(f)
-    def decorated_function(*args, **kwargs):
+    def decorated_function(self, *args, **kwargs):
+        # nested call, user already resolved by the outer method
+        if getattr(self, '_current_user', None):
+            return f(self, *args, **kwargs)
+
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        return f(*args, **kwargs)
+        self._current_user = user
+        self._current_user_id = getUserId(user)
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            self._current_user = self._current_user_id = None
 
     return decorated_function
 
 
+def _almost_sold_out(seats):
+    """Return True if a conference with this many seats left is nearly full."""
+    return seats is not None and 0 < seats <= ALMOST_SOLD_OUT_SEATS
+
+
+def _page_cursor(token):
+    """Return the query Cursor for a pageToken, None for the first page."""
+    if not token:
+        return None
+    try:
+        return Cursor(urlsafe=token)
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid pageToken: %s' % token)
+
+
+def _page_size(size):
+    """Return the query page size for a pageSize, clamped to MAX_PAGE_SIZE."""
+    if size is None:
+        return DEFAULT_PAGE_SIZE
+    if size <= 0:
+        raise endpoints.BadRequestException(
+            'pageSize must be positive: %s' % size)
+    return min(size, MAX_PAGE_SIZE)
+
+
+def _parse_ymd(s):
+    """Parse the leading "YYYY-MM-DD" of a string into a date; like
+    strptime, month and day may be given with one digit.
+    """
+    year, month, day = s[:10].split('-')
+    return date(int(year), int(month), int(day))
+
+
+def _parse_hm(s):
+    """Parse the leading "HH:MM" of a string into a time; like strptime,
+    the hour may be given with one digit.
+    """
+    hour, minute = s[:5].split(':')
+    return time(int(hour), int(minute))
+
+
+# - - - Form field plans - - - - - - - - - - - - - - - - - - -
+
+# how a form field is filled in from its entity
+(PLAIN, DATE_STR, TIME_STR, WEBSAFE_KEY, WEBSAFE_KEYS, ENUM_TEESHIRT,
+ SPEAKER_KEY) = range(7)
+
+COPY_HANDLERS = {
+    PLAIN: lambda form, obj, name: setattr(form, name, getattr(obj, name)),
+    DATE_STR: lambda form, obj, name: setattr(form, name,
+                                              str(getattr(obj, name))),
+    TIME_STR: lambda form, obj, name: setattr(form, name,
+                                              str(getattr(obj, name))),
+    WEBSAFE_KEY: lambda form, obj, name: setattr(form, name,
+                                                 obj.key.urlsafe()),
+    WEBSAFE_KEYS: lambda form, obj, name: setattr(
+        form, name, [key.urlsafe() for key in getattr(obj, name)]),
+    ENUM_TEESHIRT: lambda form, obj, name: setattr(
+        form, name, getattr(TeeShirtSize, getattr(obj, name))),
+    SPEAKER_KEY: lambda form, obj, name: setattr(
+        form, name, obj.speaker.urlsafe() if obj.speaker else obj.speakerKey),
+}
+
+
+def _field_plan(form_cls, model_cls, kinds):
+    """Return (name, kind) pairs for form fields copied from an entity.
+
+    Fields listed in kinds get that kind, fields that also exist on the
+    model are copied as PLAIN and everything else is skipped.
+    """
+    plan = []
+    for field in form_cls.all_fields():
+        if field.name in kinds:
+            plan.append((field.name, kinds[field.name]))
+        elif hasattr(model_cls, field.name):
+            plan.append((field.name, PLAIN))
+    return tuple(plan)
+
+
+CONF_FIELD_PLAN = _field_plan(ConferenceForm, Conference, {
+    'startDate': DATE_STR,
+    'endDate': DATE_STR,
+    'websafeKey': WEBSAFE_KEY,
+})
+PROFILE_FIELD_PLAN = _field_plan(ProfileForm, Profile, {
+    'teeShirtSize': ENUM_TEESHIRT,
+    'conferenceKeysToAttend': WEBSAFE_KEYS,
+})
+SPEAKER_FIELD_PLAN = _field_plan(SpeakerForm, Speaker, {
+    'websafeKey': WEBSAFE_KEY,
+})
+SESSION_FIELD_PLAN = _field_plan(SessionForm, Session, {
+    'speakerKey': SPEAKER_KEY,
+    'date': DATE_STR,
+    'startTime': TIME_STR,
+})
+
+# names of the inbound form fields, copied by the create methods
+CONFERENCE_FIELDS = tuple(field.name for field in ConferenceForm.all_fields())
+SPEAKER_FIELDS = tuple(field.name for field in SpeakerForm.all_fields())
+SESSION_FIELDS = tuple(field.name for field in SessionForm.all_fields())
+
+# (name, repeated) pairs of the inbound form fields, copied by the update
+# methods; unset fields are None, or an empty list if repeated
+CONFERENCE_UPDATE_FIELDS = tuple((field.name, field.repeated)
+                                 for field in ConferenceForm.all_fields())
+SPEAKER_UPDATE_FIELDS = tuple((field.name, field.repeated)
+                              for field in SpeakerForm.all_fields())
+SESSION_UPDATE_FIELDS = tuple((field.name, field.repeated)
+                              for field in SessionForm.all_fields())
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -146,17 +304,11 @@ class ConferenceApi(remote.Service):
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
         cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        # convert Date to date string, key to websafe key; just copy others
+        for name, kind in CONF_FIELD_PLAN:
+            COPY_HANDLERS[kind](cf, conf, name)
         if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
+            cf.organizerDisplayName = displayName
         cf.check_initialized()
         return cf
 
@@ -169,8 +321,7 @@ class ConferenceApi(remote.Service):
                 "Conference 'name' field required")
 
         # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in
-                request.all_fields()}
+        data = {name: getattr(request, name) for name in CONFERENCE_FIELDS}
         del data['websafeKey']
         del data['organizerDisplayName']
 
@@ -182,22 +333,20 @@ class ConferenceApi(remote.Service):
 
         # convert dates from strings to Date objects; set month based on start_date
         if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10],
-                                                  "%Y-%m-%d").date()
+            data['startDate'] = _parse_ymd(data['startDate'])
             data['month'] = data['startDate'].month
         else:
             data['month'] = 0
         if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10],
-                                                "%Y-%m-%d").date()
+            data['endDate'] = _parse_ymd(data['endDate'])
 
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
-        user = endpoints.get_current_user()
-        user_id = getUserId(user)
+        user = self._current_user
+        user_id = self._current_user_id
         p_key = ndb.Key(Profile, user_id)
         c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
@@ -206,49 +355,56 @@ class ConferenceApi(remote.Service):
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
+        conf = Conference(**data)
+        conf.put()
+        # enqueue the email while the almost sold out list is updated;
+        # the cron job sends queued emails in batches
+        email_rpc = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE).add_async(
+            taskqueue.Task(payload=json.dumps({
+                'email': user.email(),
+                'conferenceInfo': repr(request)}), method='PULL'))
+        self._trackAlmostSoldOut(conf, False)
+        email_rpc.get_result()
         return request
 
     @login_required
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in
-                request.all_fields()}
+        # fetch existing conference and its organizer profile (the parent
+        # key, so it stays inside the conference entity group) in parallel
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf_future = c_key.get_async()
+        prof_future = c_key.parent().get_async()
 
-        # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         # check that conference exists
+        conf = conf_future.get_result()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
 
         # check that user is owner
-        user = endpoints.get_current_user()
-        user_id = getUserId(user)
+        user_id = self._current_user_id
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
-        for field in request.all_fields():
-            data = getattr(request, field.name)
+        was_almost_sold_out = _almost_sold_out(conf.seatsAvailable)
+        for name, repeated in CONFERENCE_UPDATE_FIELDS:
+            data = getattr(request, name)
             # only copy fields where we get data
-            if data not in (None, []):
+            if data is not None and (data or not repeated):
                 # special handling for dates (convert string to Date)
-                if field.name in ('startDate', 'endDate'):
-                    data = datetime.strptime(data, "%Y-%m-%d").date()
-                    if field.name == 'startDate':
+                if name in ('startDate', 'endDate'):
+                    data = _parse_ymd(data)
+                    if name == 'startDate':
                         conf.month = data.month
                 # write to Conference object
-                setattr(conf, field.name, data)
+                setattr(conf, name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+        self._trackAlmostSoldOut(conf, was_almost_sold_out)
+        prof = prof_future.get_result()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -284,17 +440,22 @@ class ConferenceApi(remote.Service):
     @login_required
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
-        user = endpoints.get_current_user()
-        user_id = getUserId(user)
+        user_id = self._current_user_id
 
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        # create keys only ancestor query for all key matches for this user
+        # and fetch the organizer profile alongside it, then batch get the
+        # conferences (cached by ndb)
+        p_key = ndb.Key(Profile, user_id)
+        keys_future = Conference.query(ancestor=p_key).fetch_async(
+            batch_size=500, keys_only=True)
+        prof_future = p_key.get_async()
+        confs_future = ndb.get_multi_async(keys_future.get_result())
+        displayName = getattr(prof_future.get_result(), 'displayName')
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[
-                self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
-                for conf in confs]
+            items=[self._copyConferenceToForm(conf_future.get_result(),
+                                              displayName)
+                   for conf_future in confs_future]
         )
 
     def _getQuery(self, request):
@@ -324,13 +485,11 @@ class ConferenceApi(remote.Service):
         inequality_field = None
 
         for f in filters:
-            filtr = {field.name: getattr(f, field.name) for field in
-                     f.all_fields()}
+            filtr = {"field": FIELDS.get(f.field),
+                     "operator": OPERATORS.get(f.operator),
+                     "value": f.value}
 
-            try:
-                filtr["field"] = FIELDS[filtr["field"]]
-                filtr["operator"] = OPERATORS[filtr["operator"]]
-            except KeyError:
+            if filtr["field"] is None or filtr["operator"] is None:
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
 
@@ -354,25 +513,25 @@ class ConferenceApi(remote.Service):
                       name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        # run the query once and reuse the results below
+        conferences = self._getQuery(request).fetch(batch_size=500)
 
         # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in
-                      conferences]
-        profiles = ndb.get_multi(organisers)
+        # get unique organiser keys and use get_multi for speed
+        organisers = set(conf.organizerUserId for conf in conferences)
+        profiles = ndb.get_multi(
+            [ndb.Key(Profile, user_id) for user_id in organisers])
 
         # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        names = {profile.key.id(): profile.displayName
+                 for profile in profiles if profile}
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
             items=[
-                self._copyConferenceToForm(conf, names[conf.organizerUserId])
-                for conf in \
-                conferences]
+                self._copyConferenceToForm(
+                    conf, names.get(conf.organizerUserId))
+                for conf in conferences]
         )
 
     # - - - Profile objects - - - - - - - - - - - - - - - - - - -
@@ -381,22 +540,17 @@ class ConferenceApi(remote.Service):
         """Copy relevant fields from Profile to ProfileForm."""
         # copy relevant fields from Profile to ProfileForm
         pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name,
-                            getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
+        # convert t-shirt string to Enum; just copy others
+        for name, kind in PROFILE_FIELD_PLAN:
+            COPY_HANDLERS[kind](pf, prof, name)
         pf.check_initialized()
         return pf
 
     @login_required
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
-        user = endpoints.get_current_user()
-        user_id = getUserId(user)
+        user = self._current_user
+        user_id = self._current_user_id
         p_key = ndb.Key(Profile, user_id)
         profile = p_key.get()
         # create new Profile if not there
@@ -408,6 +562,13 @@ class ConferenceApi(remote.Service):
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
             profile.put()
+        # move conferences stored as websafe strings over to keys
+        elif profile.legacyConferenceKeysToAttend:
+            profile.conferenceKeysToAttend.extend(
+                ndb.Key(urlsafe=wsck)
+                for wsck in profile.legacyConferenceKeysToAttend)
+            profile.legacyConferenceKeysToAttend = []
+            profile.put()
 
         return profile  # return Profile
 
@@ -418,16 +579,20 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            dirty = False
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
-                    if val:
+                    if val and str(val) != getattr(prof, field):
                         setattr(prof, field, str(val))
                         # if field == 'teeShirtSize':
                         #    setattr(prof, field, str(val).upper())
                         # else:
                         #    setattr(prof, field, val)
-                        prof.put()
+                        dirty = True
+            # only write the Profile back if something changed
+            if dirty:
+                prof.put()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -451,10 +616,19 @@ class ConferenceApi(remote.Service):
         """Create Announcement & assign to memcache; used by
         memcache cron job & putAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
+        almost_sold_out = ALMOST_SOLD_OUT_KEY.get()
+        if not almost_sold_out or not almost_sold_out.seeded:
+            # first run: seed the list with a one-off query, afterwards
+            # it is kept up to date by _trackAlmostSoldOut()
+            almost_sold_out = ConferenceApi._seedAlmostSoldOut(
+                Conference.query(ndb.AND(
+                    Conference.seatsAvailable <= ALMOST_SOLD_OUT_SEATS,
+                    Conference.seatsAvailable > 0)
+                ).fetch(keys_only=True))
+        # the seed query is eventually consistent, so check the seats again
+        confs = [conf for conf in
+                 ndb.get_multi(almost_sold_out.conferenceKeys)
+                 if conf and _almost_sold_out(conf.seatsAvailable)]
 
         if confs:
             # If there are almost sold out conferences,
@@ -470,6 +644,43 @@ class ConferenceApi(remote.Service):
 
         return announcement
 
+    @staticmethod
+    @ndb.transactional
+    def _seedAlmostSoldOut(conf_keys):
+        """Merge the seed query's conf_keys into the almost sold out list,
+        keeping conferences _trackAlmostSoldOut() added meanwhile.
+        """
+        almost_sold_out = (ALMOST_SOLD_OUT_KEY.get() or
+                           AlmostSoldOut(key=ALMOST_SOLD_OUT_KEY))
+        if not almost_sold_out.seeded:
+            keys = almost_sold_out.conferenceKeys
+            keys.extend(key for key in conf_keys if key not in keys)
+            almost_sold_out.seeded = True
+            almost_sold_out.put()
+        return almost_sold_out
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _trackAlmostSoldOut(conf, was_almost_sold_out):
+        """Add or remove conf from the almost sold out list when its
+        seatsAvailable crosses the announcement threshold.
+        """
+        is_almost_sold_out = _almost_sold_out(conf.seatsAvailable)
+        if is_almost_sold_out == was_almost_sold_out:
+            return
+        # create the list if it isn't there yet; _seedAlmostSoldOut()
+        # merges the seed query into it later
+        almost_sold_out = (ALMOST_SOLD_OUT_KEY.get() or
+                           AlmostSoldOut(key=ALMOST_SOLD_OUT_KEY))
+        keys = almost_sold_out.conferenceKeys
+        if is_almost_sold_out and conf.key not in keys:
+            keys.append(conf.key)
+        elif not is_almost_sold_out and conf.key in keys:
+            keys.remove(conf.key)
+        else:
+            return
+        almost_sold_out.put()
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
@@ -484,20 +695,25 @@ class ConferenceApi(remote.Service):
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
+        # start fetching the conference while the user Profile is loaded
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        conf_future = c_key.get_async()
         prof = self._getProfileFromUser()  # get user Profile
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
-        wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = conf_future.get_result()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        was_almost_sold_out = _almost_sold_out(conf.seatsAvailable)
+
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if c_key in prof.conferenceKeysToAttend:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -507,17 +723,17 @@ class ConferenceApi(remote.Service):
                     "There are no seats available.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
+            prof.conferenceKeysToAttend.append(c_key)
             conf.seatsAvailable -= 1
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if c_key in prof.conferenceKeysToAttend:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
+                prof.conferenceKeysToAttend.remove(c_key)
                 conf.seatsAvailable += 1
                 retval = True
             else:
@@ -526,6 +742,7 @@ class ConferenceApi(remote.Service):
         # write things back to the datastore & return
         prof.put()
         conf.put()
+        self._trackAlmostSoldOut(conf, was_almost_sold_out)
         return BooleanMessage(data=retval)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -534,25 +751,22 @@ class ConferenceApi(remote.Service):
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser()  # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in
-                     prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        conferences = ndb.get_multi(prof.conferenceKeysToAttend)
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in
-                      conferences]
-        profiles = ndb.get_multi(organisers)
+        # get unique organizers
+        organisers = set(conf.organizerUserId for conf in conferences)
+        profiles = ndb.get_multi(
+            [ndb.Key(Profile, user_id) for user_id in organisers])
 
         # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        names = {profile.key.id(): profile.displayName
+                 for profile in profiles if profile}
 
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(items=[
-            self._copyConferenceToForm(conf, names[conf.organizerUserId]) \
+            self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
             for conf in conferences]
-                               )
+        )
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
@@ -582,9 +796,11 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.city == "London")
         q = q.filter(Conference.topics == "Medical Innovations")
         q = q.filter(Conference.month == 6)
+        conferences = q.fetch(batch_size=500)
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf, "")
+                   for conf in conferences]
         )
 
     # Task 1:
@@ -592,11 +808,8 @@ class ConferenceApi(remote.Service):
     def _copySpeakerToForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
         form = SpeakerForm()
-        for field in form.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(form, field.name, getattr(speaker, field.name))
-            elif field.name == "websafeKey":
-                setattr(form, field.name, speaker.key.urlsafe())
+        for name, kind in SPEAKER_FIELD_PLAN:
+            COPY_HANDLERS[kind](form, speaker, name)
         form.check_initialized()
         return form
 
@@ -604,8 +817,7 @@ class ConferenceApi(remote.Service):
     def _createSpeakerObject(self, request):
         """Create Speaker object, returning SpeakerForm/request."""
         # Get request values into dictionary
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
+        data = {name: getattr(request, name) for name in SPEAKER_FIELDS}
         del data['websafeKey']
         # Create Speaker
         speaker = Speaker(**data).put()
@@ -615,10 +827,6 @@ class ConferenceApi(remote.Service):
     @ndb.transactional()
     def _updateSpeakerObject(self, request):
         """Update Speaker object, returning SpeakerForm/request."""
-        # Get request values into dictionary
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
-
         # Get Speaker from speaker key
         speaker = ndb.Key(urlsafe=request.websafeSpeakerKey).get()
         # Check if he exists
@@ -627,15 +835,24 @@ class ConferenceApi(remote.Service):
                 'No speaker found with key: %s' % request.websafeSpeakerKey)
 
         # Update values which were given in request
-        for field in request.all_fields():
-            data = getattr(request, field.name)
+        for name, repeated in SPEAKER_UPDATE_FIELDS:
+            data = getattr(request, name)
             # only copy fields where we get data
-            if data not in (None, []):
+            if data is not None and (data or not repeated):
                 # write to Speaker object
-                setattr(speaker, field.name, data)
+                setattr(speaker, name, data)
         speaker.put()
+        self._flushBestSpeakers()
         return self._copySpeakerToForm(speaker)
 
+    @staticmethod
+    def _flushBestSpeakers():
+        """Drop the cached best speakers once the current transaction
+        commits, so a read in between can't cache the old ranking again.
+        """
+        ndb.get_context().call_on_commit(
+            lambda: memcache.delete(MEMCACHE_BEST_SPEAKERS_KEY))
+
     @endpoints.method(SpeakerForm, SpeakerForm, path='speaker/create',
                       http_method='POST', name='createSpeaker')
     def createSpeaker(self, request):
@@ -668,7 +885,7 @@ class ConferenceApi(remote.Service):
     def GetAllSpeakers(self, request):
         """Get all speakers."""
         # Query all speakers
-        speakers = Speaker.query().fetch()
+        speakers = Speaker.query().fetch(batch_size=500)
         # Return them invidually via Speaker Form
         return SpeakerForms(
             items=[self._copySpeakerToForm(item) for item in speakers]
@@ -678,46 +895,49 @@ class ConferenceApi(remote.Service):
     def _copySessionToForm(self, session):
         """Copy fields from Session to SessionForm."""
         form = SessionForm()
-        for field in form.all_fields():
-            if hasattr(session, field.name):
-                if field.name in ['startTime', 'date']:
-                    setattr(
-                        form, field.name, str(getattr(session, field.name)))
-                else:
-                    setattr(form, field.name, getattr(session, field.name))
-            elif field.name == "websafeConferenceKey":
-                setattr(form, field.name, session.key.urlsafe())
+        # convert date and time to strings; just copy others
+        for name, kind in SESSION_FIELD_PLAN:
+            COPY_HANDLERS[kind](form, session, name)
         form.check_initialized()
         return form
 
+    def _copySessionPageToForms(self, page):
+        """Copy a (sessions, cursor, more) page of results to SessionForms."""
+        sessions, cursor, more = page
+        return SessionForms(
+            items=[self._copySessionToForm(item) for item in sessions],
+            nextPageToken=cursor.urlsafe() if more and cursor else None
+        )
+
     @login_required
+    @ndb.transactional(xg=True)
     def _createSessionObject(self, request):
         """Create Session object, returning SessionForm/request."""
         # Copy values into dictionary
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
+        data = {name: getattr(request, name) for name in SESSION_FIELDS}
 
         # Change data format
         if data['date']:
-            data['date'] = datetime.strptime(
-                data['date'][:10], "%Y-%m-%d").date()
+            data['date'] = _parse_ymd(data['date'])
 
         # Change time format
         if data['startTime']:
-            data['startTime'] = datetime.strptime(
-                data['startTime'][:5], "%H:%M").time()
+            data['startTime'] = _parse_hm(data['startTime'])
 
-        # Get Speaker
+        # Get Speaker and Conference in parallel
         speakerKey = ndb.Key(urlsafe=request.speakerKey)
-        speaker = speakerKey.get()
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        speaker_future = speakerKey.get_async()
+        conf_future = c_key.get_async()
+
         # Check if speaker exists
+        speaker = speaker_future.get_result()
         if not speaker:
             raise endpoints.NotFoundException(
                 'No speaker found with key: %s' % request.speakerKey)
 
         # Check if conference exists
-        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        conf = c_key.get()
+        conf = conf_future.get_result()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
@@ -727,26 +947,27 @@ class ConferenceApi(remote.Service):
         s_id = Session.allocate_ids(size=1, parent=c_key)[0]
         s_key = ndb.Key(Session, s_id, parent=c_key)
         data['key'] = s_key
+        # Store the speaker as a key
+        del data['speakerKey']
+        data['speaker'] = speakerKey
         # Create session entity
         session = Session(**data).put()
-        # Task 4 - set memcache entry
+        self._addSessionType(conf, request.typeOfSession)
+        self._flushSessionCaches(c_key)
+        # Task 4 - set memcache entry; enqueued only if the session commits
         taskqueue.add(params={'speakerKey': request.speakerKey,
                               'speakerName': speaker.name,
                               'sessionName': request.name,
+                              'websafeSessionKey': s_key.urlsafe(),
                               'websafeConferenceKey': request.websafeConferenceKey},
-                      url='/tasks/set_featured_speaker')
+                      url='/tasks/set_featured_speaker',
+                      transactional=True)
         return request
 
     @login_required
     @ndb.transactional(xg=True)
     def _updateSessionObject(self, request):
         """Update Session object."""
-        # Get data into dictionary
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
-        del data['websafeSessionKey']
-        del data['websafeConferenceKey']
-
         # Get session from session key
         session = ndb.Key(urlsafe=request.websafeSessionKey).get()
         # Check if session exists
@@ -762,21 +983,41 @@ class ConferenceApi(remote.Service):
                 raise endpoints.NotFoundException(
                     'No speaker found with key: %s' % request.speakerKey)
 
+        # move a speaker stored as a websafe string over to a key
+        if session.speakerKey:
+            if not session.speaker:
+                session.speaker = ndb.Key(urlsafe=session.speakerKey)
+            session.speakerKey = None
+
         # Set changed fields
-        for field in request.all_fields():
-            data = getattr(request, field.name)
+        for name, repeated in SESSION_UPDATE_FIELDS:
+            data = getattr(request, name)
             # only copy fields where we get data
-            if data not in (None, []):
+            if data is not None and (data or not repeated):
                 # special handling for dates (convert string to Date)
-                if field.name in ('date'):
-                    data = datetime.strptime(data, "%Y-%m-%d").date()
-                if field.name in ('startTime'):
-                    data = datetime.strptime(data, "%H:%M").time()
+                if name == 'date':
+                    data = _parse_ymd(data)
+                elif name == 'startTime':
+                    data = _parse_hm(data)
+                # speaker is stored as a key
+                elif name == 'speakerKey':
+                    name, data = 'speaker', speakerKey if data else None
                 # write to Session object
-                setattr(session, field.name, data)
+                setattr(session, name, data)
         session.put()
+        if request.typeOfSession:
+            self._addSessionType(session.key.parent().get(),
+                                 request.typeOfSession)
+        self._flushSessionCaches(session.key.parent())
         return self._copySessionToForm(session)
 
+    @staticmethod
+    def _addSessionType(conf, typeOfSession):
+        """Record typeOfSession in the conference's list of session types."""
+        if conf and typeOfSession and typeOfSession not in conf.sessionTypes:
+            conf.sessionTypes.append(typeOfSession)
+            conf.put()
+
     @endpoints.method(SessionForm, SessionForm,
                       path='conference/session/create',
                       http_method='POST', name='createSession')
@@ -798,17 +1039,30 @@ class ConferenceApi(remote.Service):
     def getConferenceSessions(self, request):
         """Get Sessions by conference key"""
         c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        conf = c_key.get()
+        page_size = _page_size(request.pageSize)
+        # The default first page is kept in memcache for MEMCACHE_QUERY_TTL
+        # seconds or until a session of the conference is created or updated
+        cache_key = None
+        if not request.pageToken and page_size == DEFAULT_PAGE_SIZE:
+            cache_key = MEMCACHE_CONF_SESSIONS_TPL % c_key.urlsafe()
+            cached = memcache.get(cache_key)
+            if cached is not None:
+                return protobuf.decode_message(SessionForms, cached)
+        # Get conference and a page of its sessions in parallel; sessions
+        # aren't kept in memcache, so one query beats keys plus get_multi
+        conf_future = c_key.get_async()
+        page_future = Session.query(ancestor=c_key).fetch_page_async(
+            page_size, start_cursor=_page_cursor(request.pageToken))
         # Check if conference exists
-        if not conf:
+        if not conf_future.get_result():
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
                 % request.websafeConferenceKey)
-        # Get conference sessions
-        sessions = Session.query(ancestor=c_key).fetch()
-        return SessionForms(
-            items=[self._copySessionToForm(item) for item in sessions]
-        )
+        forms = self._copySessionPageToForms(page_future.get_result())
+        if cache_key:
+            memcache.set(cache_key, protobuf.encode_message(forms),
+                         time=MEMCACHE_QUERY_TTL)
+        return forms
 
     @endpoints.method(SESSION_GET_BY_CONF_TYPE_REQUEST, SessionForms,
                       path='conference/session/get_by_conf_and_type/'
@@ -817,20 +1071,20 @@ class ConferenceApi(remote.Service):
     def getConferenceSessionsByType(self, request):
         """Get Sessions by conference key and typeOfSession"""
         c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        conf = c_key.get()
+        # Get conference and filter sessions with given type in parallel
+        conf_future = c_key.get_async()
+        page_future = Session.query(ancestor=c_key).filter(
+            Session.typeOfSession == request.typeOfSession).fetch_page_async(
+            _page_size(request.pageSize),
+            start_cursor=_page_cursor(request.pageToken))
         # Check if conference exists
-        if not conf:
+        if not conf_future.get_result():
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
-                % request.websafeSessionKey)
-        # Filter sessions with given type of session
-        sessions = Session.query(ancestor=c_key).filter(
-            Session.typeOfSession == request.typeOfSession).fetch()
-        return SessionForms(
-            items=[self._copySessionToForm(item) for item in sessions]
-        )
+                % request.websafeConferenceKey)
+        return self._copySessionPageToForms(page_future.get_result())
 
-    @endpoints.method(SPEAKER_GET_REQUEST, SessionForms,
+    @endpoints.method(SPEAKER_SESSIONS_REQUEST, SessionForms,
                       path='conference/session/get_by_speaker/'
                            + '{websafeSpeakerKey}',
                       http_method='GET', name='getSessionsBySpeaker')
@@ -843,13 +1097,17 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No speaker found with key: %s' % request.websafeSpeakerKey)
 
-        # Query sessions with given speaker key
-        sessions = Session.query(
-            Session.speakerKey == request.websafeSpeakerKey).fetch()
+        # Query sessions with given speaker key, including sessions
+        # not yet moved over from the websafe string; paging an OR query
+        # needs a key order
+        page = Session.query(ndb.OR(
+            Session.speaker == speakerKey,
+            Session.speakerKey == request.websafeSpeakerKey)).order(
+            Session.key).fetch_page(
+            _page_size(request.pageSize),
+            start_cursor=_page_cursor(request.pageToken))
         # return SessionForms object
-        return SessionForms(
-            items=[self._copySessionToForm(item) for item in sessions]
-        )
+        return self._copySessionPageToForms(page)
 
     # Task 2
     # - - - Wishlist - - - - - - - - - - - - - - - - - - - -
@@ -863,26 +1121,21 @@ class ConferenceApi(remote.Service):
         """Add Session to Wishlist by Session key"""
         prof = self._getProfileFromUser()
 
+        # Already in wishlist, so the session was checked when added
+        if request.websafeSessionKey in prof.sessionKeysOnWishlist:
+            return BooleanMessage(data=False)
+
         session_key = ndb.Key(urlsafe=request.websafeSessionKey)
         session = session_key.get()
         # Check if session exists
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % request.websafeSessionKey)
-        # Add session to user profile
-        try:
-            if request.websafeSessionKey in prof.sessionKeysOnWishlist:
-                raise ConflictException(
-                    "You already have this in your wishlist"
-                )
-            # Add session to wishlist
-            prof.sessionKeysOnWishlist.append(request.websafeSessionKey)
-            prof.put()
-            result = True
-        except:
-            result = False
+        # Add session to wishlist
+        prof.sessionKeysOnWishlist.append(request.websafeSessionKey)
+        prof.put()
         # return BooleanMessage
-        return BooleanMessage(data=result)
+        return BooleanMessage(data=True)
 
     @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
                       path='deleteSessionFromWishlist',
@@ -892,27 +1145,19 @@ class ConferenceApi(remote.Service):
     def deleteSessionFromWishlist(self, request):
         """Delete Session from Wishlist by session key"""
         prof = self._getProfileFromUser()
-        # Check if session exists
+        # If session key in wishlist remove it; it was checked on add
+        if request.websafeSessionKey in prof.sessionKeysOnWishlist:
+            prof.sessionKeysOnWishlist.remove(request.websafeSessionKey)
+            prof.put()
+            return BooleanMessage(data=True)
+
+        # Not in wishlist; check if session exists at all
         session_key = ndb.Key(urlsafe=request.websafeSessionKey)
         session = session_key.get()
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % request.websafeSessionKey)
-        result = False
-        try:
-            # If session key in wishlist remove it, else raise exception
-            if request.websafeSessionKey in prof.sessionKeysOnWishlist:
-                prof.sessionKeysOnWishlist.remove(request.websafeSessionKey)
-                prof.put()
-                result = True
-
-            else:
-                raise endpoints.NotFoundException(
-                    'No session found in wishlist with key: %s' % request.websafeSessionKey)
-        except:
-            result = False
-
-        return BooleanMessage(data=result)
+        return BooleanMessage(data=False)
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='wishlist',
@@ -920,10 +1165,12 @@ class ConferenceApi(remote.Service):
     def getSessionsInWishlist(self, request):
         """Get Sessions from wishlist"""
         prof = self._getProfileFromUser()
+        # Get all wishlist sessions in one batch
+        sessions = ndb.get_multi([ndb.Key(urlsafe=item)
+                                  for item in prof.sessionKeysOnWishlist])
         return SessionForms(
-            items=[self._copySessionToForm(
-                ndb.Key(urlsafe=item).get())
-                   for item in prof.sessionKeysOnWishlist]
+            items=[self._copySessionToForm(session)
+                   for session in sessions if session]
         )
 
     # Task 3
@@ -933,27 +1180,41 @@ class ConferenceApi(remote.Service):
                       http_method='GET', name='getBestSpeakers')
     def getSpeakersWithMostSessions(self, request):
         """Get Speakers with most sessions"""
+        # Serve from memcache if a recent result is there
+        cached = memcache.get(MEMCACHE_BEST_SPEAKERS_KEY)
+        if cached is not None:
+            return protobuf.decode_message(SpeakerForms, cached)
         # Get top 5 featured speakers
         speakers = Speaker.query(
             Speaker.sessions_count > 0).order(-Speaker.sessions_count) \
             .fetch(5)
-        return SpeakerForms(
+        forms = SpeakerForms(
             items=[self._copySpeakerToForm(item) for item in speakers]
         )
+        memcache.set(MEMCACHE_BEST_SPEAKERS_KEY,
+                     protobuf.encode_message(forms), time=MEMCACHE_QUERY_TTL)
+        return forms
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='conference/session/get_upcoming_sessions',
                       http_method='GET', name='getUpcomingSessions')
     def getUpcomingSessions(self, request):
         """Get Upcoming Sessions """
+        # Serve from memcache if a recent result is there
+        cached = memcache.get(MEMCACHE_UPCOMING_SESSIONS_KEY)
+        if cached is not None:
+            return protobuf.decode_message(SessionForms, cached)
         # Get current date and time
         startTime = datetime.now()
         # Filter session by current date and get nearest 5 records
         sessions = Session.query().filter(
             Session.date >= startTime).order(Session.date).fetch(5)
-        return SessionForms(
+        forms = SessionForms(
             items=[self._copySessionToForm(item) for item in sessions]
         )
+        memcache.set(MEMCACHE_UPCOMING_SESSIONS_KEY,
+                     protobuf.encode_message(forms), time=MEMCACHE_QUERY_TTL)
+        return forms
 
     # - - - Problem query - - - - - - - - - - - - - - - - - - - -
     @endpoints.method(SESSION_GET_BY_TYPE_TIME_REQUEST, SessionForms,
@@ -961,42 +1222,117 @@ class ConferenceApi(remote.Service):
                       http_method='POST', name='getSessionsByNotLike')
     def getSessionsByNotLike(self, request):
         """Get Sessions with other then chosen typeOfSession and before startTime """
-        # Get start time
-        start_time = datetime.strptime(request.startTime, "%H:%M").time()
-        # Get type of sessions which user wants to attend
-        only_types_sessions = Session.query(
-            projection=[Session.typeOfSession],
-            distinct=True).filter(
-            Session.typeOfSession != request.typeOfSession).fetch()
-        types = [sessions.typeOfSession for sessions in only_types_sessions]
-        # Filter sessions with type and start time
-        sessions = Session.query(
-            Session.typeOfSession.IN(types)) \
-            .filter(Session.startTime <= start_time).fetch()
-        return SessionForms(
-            items=[self._copySessionToForm(item) for item in sessions]
-        )
+        # Get start time; reject bad input before any query is issued
+        try:
+            start_time = _parse_hm(request.startTime)
+        except (TypeError, ValueError):
+            raise endpoints.BadRequestException(
+                "'startTime' must be given as HH:MM")
+        page_size = _page_size(request.pageSize)
+        # Get type of sessions which user wants to attend, from the
+        # conference itself if the query is limited to one
+        if request.websafeConferenceKey:
+            c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+            conf = c_key.get()
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s'
+                    % request.websafeConferenceKey)
+            if conf.sessionTypesBackfilled:
+                all_types = conf.sessionTypes
+            else:
+                all_types = self._backfillSessionTypes(c_key)
+            query = Session.query(ancestor=c_key)
+        else:
+            all_types = self._getSessionTypes()
+            query = Session.query()
+        types = [typeOfSession for typeOfSession in all_types
+                 if typeOfSession != request.typeOfSession]
+        if not types:
+            return SessionForms()
+        # Filter sessions with type and start time; paging an IN query
+        # needs a key order
+        page = query.filter(Session.typeOfSession.IN(types)) \
+            .filter(Session.startTime <= start_time) \
+            .order(Session.startTime, Session.key).fetch_page(
+            page_size, start_cursor=_page_cursor(request.pageToken))
+        return self._copySessionPageToForms(page)
+
+    @staticmethod
+    def _getSessionTypes():
+        """Return all distinct session types, cached in memcache for
+        MEMCACHE_QUERY_TTL seconds or until a session is created or updated.
+        """
+        types = memcache.get(MEMCACHE_SESSION_TYPES_KEY)
+        if types is None:
+            # the projection query is eventually consistent, so a new type
+            # may be missing for a moment; the TTL bounds how long
+            # untyped sessions are left out, as in Conference.sessionTypes
+            types = [session.typeOfSession for session in Session.query(
+                projection=[Session.typeOfSession], distinct=True).fetch()
+                if session.typeOfSession]
+            memcache.set(MEMCACHE_SESSION_TYPES_KEY, types,
+                         time=MEMCACHE_QUERY_TTL)
+        return types
+
+    @staticmethod
+    def _backfillSessionTypes(c_key):
+        """Merge the types of the conference's existing sessions into its
+        sessionTypes, once, and return the full list.
+        """
+        types = [session.typeOfSession for session in Session.query(
+            ancestor=c_key, projection=[Session.typeOfSession],
+            distinct=True).fetch() if session.typeOfSession]
+        return ConferenceApi._addSessionTypes(c_key, types)
+
+    @staticmethod
+    @ndb.transactional
+    def _addSessionTypes(c_key, types):
+        """Record the backfilled types in the conference's list of session
+        types and return the list.
+        """
+        conf = c_key.get()
+        if not conf.sessionTypesBackfilled:
+            conf.sessionTypes.extend(
+                typeOfSession for typeOfSession in types
+                if typeOfSession not in conf.sessionTypes)
+            conf.sessionTypesBackfilled = True
+            conf.put()
+        return conf.sessionTypes
+
+    @staticmethod
+    def _flushSessionCaches(c_key):
+        """Drop the cached session results touching conference c_key once
+        the current transaction commits, so a read in between can't cache
+        the old results again.
+        """
+        ndb.get_context().call_on_commit(
+            lambda: memcache.delete_multi([
+                MEMCACHE_UPCOMING_SESSIONS_KEY,
+                MEMCACHE_SESSION_TYPES_KEY,
+                MEMCACHE_CONF_SESSIONS_TPL % c_key.urlsafe()]))
 
     # Task 4
     # - - - Memcache speaker - - - - - - - - - - - - - - - - - - - -
     @staticmethod
-    def _updateSpeaker(request):
-        """Update speaker with new Session. """
+    @ndb.transactional(retries=3)
+    def _updateSpeaker(speakerKey, sessionKey, sessionName):
+        """Update speaker with new Session; safe to run more than once. """
         result = False
-        try:
-            # Get Speaker
-            speakerKey = request.get('speakerKey')
-            speaker = ndb.Key(urlsafe=speakerKey).get()
-            if speaker:
-                # Append Session to Speaker
-                speaker.sessions.append(request.get('sessionName'))
-                # Change sessions count to new number
-                speaker.sessions_count = len(speaker.sessions)
-                # Save changes
-                speaker.put()
-                result = True
-        except Exception, e:
-            print e
+        # Get Speaker
+        speaker = speakerKey.get()
+        # tasks enqueued before the session key was passed can't be checked
+        if speaker and not (sessionKey and sessionKey in speaker.sessionKeys):
+            # Append Session to Speaker
+            if sessionKey:
+                speaker.sessionKeys.append(sessionKey)
+            speaker.sessions.append(sessionName)
+            # Change sessions count to new number
+            speaker.sessions_count = len(speaker.sessions)
+            # Save changes
+            speaker.put()
+            ConferenceApi._flushBestSpeakers()
+            result = True
         return result
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
@@ -1004,8 +1340,13 @@ class ConferenceApi(remote.Service):
                       http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
         """Return featured speaker from Memcache."""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_FEATURED_SPEAKER) or "")
+        # re-read Memcache at most once per FEATURED_SPEAKER_TTL seconds
+        now = current_time()
+        if now >= featured_speaker_cache['expires']:
+            featured_speaker_cache.update(
+                value=memcache.get(MEMCACHE_FEATURED_SPEAKER) or "",
+                expires=now + FEATURED_SPEAKER_TTL)
+        return StringMessage(data=featured_speaker_cache['value'])
 
 
 api = endpoints.api_server([ConferenceApi])  # register API
@@ -6,15 +6,38 @@ main.py -- Udacity conference server-side Python App Engine
 
 """
 
+import json
+import logging
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 from conference import ConferenceApi
 from models import Session
+from conference import CONFIRMATION_EMAIL_QUEUE
 from conference import MEMCACHE_FEATURED_SPEAKER
 
+EMAIL_LEASE_SECONDS = 60
+EMAIL_BATCH_SIZE = 100
+EMAIL_MAX_RETRIES = 5
+
+
+def sendConfirmationEmail(email, conferenceInfo):
+    """Send email confirming Conference creation."""
+    mail.send_mail(
+        'noreply@%s.appspotmail.com' % (
+            app_identity.get_application_id()),  # from
+        email,  # to
+        'You created a new Conference!',  # subj
+        'Hi, you have created a following '  # body
+        'conference:\r\n\r\n%s' % conferenceInfo
+    )
+
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -25,35 +48,87 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),  # from
-            self.request.get('email'),  # to
-            'You created a new Conference!',  # subj
-            'Hi, you have created a following '  # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
+        """Send email confirming Conference creation; kept for push
+        tasks enqueued before the pull queue was used."""
+        sendConfirmationEmail(self.request.get('email'),
+                              self.request.get('conferenceInfo'))
+
+
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send a batch of queued Conference confirmation emails."""
+        queue = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE)
+        tasks = queue.lease_tasks(EMAIL_LEASE_SECONDS, EMAIL_BATCH_SIZE)
+        # tasks that were sent or will never succeed; the others are
+        # leased again once their lease runs out
+        done = []
+        try:
+            for task in tasks:
+                if self._sendTask(task):
+                    done.append(task)
+        finally:
+            if done:
+                queue.delete_tasks(done)
+        self.response.set_status(204)
+
+    @staticmethod
+    def _sendTask(task):
+        """Send the email of a leased task; return False to retry it later."""
+        if task.retry_count > EMAIL_MAX_RETRIES:
+            logging.error('Dropping confirmation email task %s after %d tries',
+                          task.name, task.retry_count)
+            return True
+        try:
+            params = json.loads(task.payload)
+            sendConfirmationEmail(params['email'], params['conferenceInfo'])
+        except (ValueError, KeyError, mail.Error), e:
+            # malformed payload or bad address, retrying won't help
+            logging.error('Dropping confirmation email task %s: %s',
+                          task.name, e)
+        except apiproxy_errors.Error, e:
+            # quota or RPC trouble, try again with the next lease
+            logging.warning('Retrying confirmation email task %s: %s',
+                            task.name, e)
+            return False
+        return True
 
 
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
         """Set FeaturedSpeaker in Memcache."""
-        # Get sessions from speaker given on conference
+        # Decode the speaker key once; a bad key won't get better on retry,
+        # so log it and let the task finish
+        websafeSpeakerKey = self.request.get('speakerKey')
+        if not websafeSpeakerKey:
+            logging.warning('Featured speaker task without a speakerKey')
+            return
+        try:
+            speakerKey = ndb.Key(urlsafe=websafeSpeakerKey)
+        except ProtocolBufferDecodeError, e:
+            logging.warning('Invalid speakerKey %r: %s', websafeSpeakerKey, e)
+            return
+        websafeSessionKey = self.request.get('websafeSessionKey')
+        sessionKey = (ndb.Key(urlsafe=websafeSessionKey)
+                      if websafeSessionKey else None)
+        # Get session names from speaker given on conference in one query
+        # (sessions not yet moved over to a speaker key match by string)
         sessions = Session.query(
-            ndb.AND(Session.speakerKey == self.request.get('speakerKey'),
+            ndb.AND(ndb.OR(Session.speaker == speakerKey,
+                           Session.speakerKey == websafeSpeakerKey),
                     Session.websafeConferenceKey == self.request.get(
-                        'websafeConferenceKey')))
-        if sessions.count() > 1:
+                        'websafeConferenceKey'))).fetch(
+            projection=[Session.name])
+        if len(sessions) > 1:
             memcache.set(MEMCACHE_FEATURED_SPEAKER,
                          '%s is Featured Speaker with sessions ' % self.request.get(
                              'speakerName')+", ".join([session.name for session in sessions]))
         # Update Speaker with Session
-        ConferenceApi._updateSpeaker(self.request)
+        ConferenceApi._updateSpeaker(speakerKey, sessionKey,
+                                     self.request.get('sessionName'))
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler)
 ], debug=True)
@@ -22,7 +22,11 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = ndb.KeyProperty('conferenceKeys',
+                                             kind='Conference', repeated=True)
+    # websafe key strings stored by older versions, moved over on load
+    legacyConferenceKeysToAttend = ndb.StringProperty(
+        'conferenceKeysToAttend', repeated=True)
     sessionKeysOnWishlist = ndb.StringProperty(repeated=True)
 
 class ProfileMiniForm(messages.Message):
@@ -62,6 +66,16 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    sessionTypes = ndb.StringProperty(repeated=True)
+    # set once sessionTypes holds the types of sessions created before it
+    sessionTypesBackfilled = ndb.BooleanProperty(default=False)
+
+
+class AlmostSoldOut(ndb.Model):
+    """AlmostSoldOut -- singleton listing nearly sold out conferences"""
+    conferenceKeys = ndb.KeyProperty(kind=Conference, repeated=True)
+    # set once the list holds the conferences found by the seed query
+    seeded = ndb.BooleanProperty(default=False)
 
 
 class ConferenceForm(messages.Message):
@@ -118,9 +132,14 @@ class ConferenceQueryForms(messages.Message):
 
 class Speaker(ndb.Model):
     """Speaker  --Speaker object"""
+    # rewritten by every featured speaker task: keep out of memcache
+    _use_memcache = False
+
     name = ndb.StringProperty(required=True)
     description = ndb.StringProperty()
     sessions = ndb.StringProperty(repeated=True)
+    # keys of the sessions counted in sessions
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True)
     sessions_count = ndb.IntegerProperty()
 
 
@@ -138,8 +157,12 @@ class SpeakerForms(messages.Message):
 
 class Session(ndb.Model):
     """Session  -- Session object"""
+    _use_memcache = False
+
     name = ndb.StringProperty(required=True)
     highlights = ndb.StringProperty()
+    speaker = ndb.KeyProperty(kind='Speaker')
+    # websafe speaker key stored by older versions, moved over on update
     speakerKey = ndb.StringProperty()
     duration = ndb.IntegerProperty()
     typeOfSession = ndb.StringProperty()
@@ -162,4 +185,5 @@ class SessionForm(messages.Message):
 
 class SessionForms(messages.Message):
     """SessionForms --- multiple Sessions outbound form message """
-    items = messages.MessageField(SessionForm, 1, repeated=True)
\ No newline at end of file
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
\ No newline at end of file